@@ -3,8 +3,8 @@ A transformer model that patches in sparse autoencoder reconstructions at each l
 Work in progress. Error nodes not implemented.
 """
 from copy import deepcopy
-from itertools import count
-from typing import Any, List, Optional, Set
+from itertools import accumulate, count, product
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch as t
 from transformer_lens import HookedTransformer
@@ -22,18 +22,33 @@ from auto_circuit.utils.patchable_model import PatchableModel
 class AutoencoderTransformer(t.nn.Module):
     wrapped_model: t.nn.Module
     sparse_autoencoders: List[SparseAutoencoder]
+    cfg: Any
+    tokenizer: Any
+    input_to_embed: Callable[..., Any]
+    _wrapped_call: Callable[..., Any]
+    _src_nodes_cache: Dict[Tuple[Any, ...], List[SrcNode]]
+    _dest_nodes_cache: Dict[Tuple[Any, ...], List[DestNode]]
 
     def __init__(self, wrapped_model: t.nn.Module, saes: List[SparseAutoencoder]):
         super().__init__()
         self.sparse_autoencoders = saes
+        # Keyed by the model shape, so pruning latents doesn't return stale nodes. Only
+        # the latest entry is kept, because pruning never restores an earlier shape.
+        self._src_nodes_cache = {}
+        self._dest_nodes_cache = {}
 
         if isinstance(wrapped_model, PatchableModel):
             self.wrapped_model = wrapped_model.wrapped_model
         else:
             self.wrapped_model = wrapped_model
+        # Plain attributes, so the hot path skips the nn.Module.__getattr__ fallback
+        self._wrapped_call = self.wrapped_model.__call__
+        self.cfg = self.wrapped_model.cfg
+        self.tokenizer = self.wrapped_model.tokenizer
+        self.input_to_embed = self.wrapped_model.input_to_embed
 
-    def forward(self, *args: Any, **kwargs: Any) -> Any:
-        return self.wrapped_model(*args, **kwargs)
+    def forward(self, input: Any, **kwargs: Any) -> Any:
+        return self._wrapped_call(input, **kwargs)
 
     def reset_activated_latents(
         self, batch_len: Optional[int] = None, seq_len: Optional[int] = None
@@ -41,72 +56,115 @@ class AutoencoderTransformer(t.nn.Module):
         for sae in self.sparse_autoencoders:
             sae.reset_activated_latents(batch_len=batch_len, seq_len=seq_len)
 
+    @t.no_grad()
     def _prune_latents_with_dataset(
         self,
         dataloader: PromptDataLoader,
         max_latents: Optional[int],
         include_corrupt: bool = False,
         seq_len: Optional[int] = None,
+        compile_model: bool = False,
+        measure_kl: bool = True,
+        autocast_bf16: bool = True,
     ):
         """
         !In place operation!
         Prune the weights of the autoencoder to remove latents that are never activated
         by the dataset. This can reduce the number of edges in the factorized model by a
         factor of 10 or more.
+
+        If `compile_model` is `True`, the forward passes are run through
+        `torch.compile`. This is faster for large datasets, but compilation happens
+        twice (before and after pruning) so it is slower for small datasets.
+
+        If `measure_kl` is `True`, the dataset is run again after pruning to print the
+        KL divergence between the pruned and unpruned outputs. Set it to `False` to skip
+        the second pass when the KL divergence isn't needed.
+
+        If `autocast_bf16` is `True` and the model is on a GPU that supports
+        `bfloat16`, the forward passes are run under `torch.autocast`. We only rank
+        latents by their total activation, which is robust to the lower precision. The
+        KL divergence is still computed in `float32`.
         """
         self.reset_activated_latents(seq_len=seq_len)
 
         print("Running dataset for autoencoder pruning...")
-        unpruned_logits = []
-        for batch_idx, batch in (batch_pbar := tqdm(enumerate(dataloader))):
-            batch_pbar.set_description_str(f"Pruning Autoencoder: Batch {batch_idx}")
-            for input_idx, prompt in (input_pbar := tqdm(enumerate(batch.clean))):
-                input_pbar.set_description_str(f"Clean Batch Input {input_idx}")
-                with t.inference_mode():
-                    out = self.forward(prompt.unsqueeze(0))  # Run one at a time
-                unpruned_logits.append(out)
-            if include_corrupt:
-                for input_idx, prompt in (input_pbar := tqdm(enumerate(batch.corrupt))):
-                    input_pbar.set_description_str(f"Corrupt Batch Input {input_idx}")
-                    with t.inference_mode():
-                        out = self.forward(prompt.unsqueeze(0))
-                    unpruned_logits.append(out)
+        forward = self._compiled_forward() if compile_model else self.forward
+        device = next(self.parameters()).device
+        bf16_supported = device.type == "cuda" and t.cuda.is_bf16_supported()
+        use_bf16 = autocast_bf16 and bf16_supported
+        autocast = t.autocast(device.type, dtype=t.bfloat16, enabled=use_bf16)
+        unpruned_logits: Optional[t.Tensor] = None
+        n_rows = 0
+        with autocast:
+            for batch_idx, batch in (batch_pbar := tqdm(enumerate(dataloader))):
+                batch_pbar_str = f"Pruning Autoencoder: Batch {batch_idx}"
+                batch_pbar.set_description_str(batch_pbar_str)
+                inputs = [batch.clean] + ([batch.corrupt] if include_corrupt else [])
+                # Latent activations are summed over the batch dim, so run whole batches
+                for toks in inputs:
+                    out = forward(toks.to(device, non_blocking=True))
+                    if not measure_kl:
+                        continue
+                    if unpruned_logits is None:
+                        # PromptDataLoader uses drop_last so all batches are equal size
+                        total = len(dataloader) * len(inputs) * out.size(0)
+                        unpruned_logits = t.empty(
+                            (total,) + out.shape[1:],
+                            dtype=out.dtype,
+                            pin_memory=out.is_cuda,
+                        )
+                    batch_rows = slice(n_rows, n_rows + out.size(0))
+                    unpruned_logits[batch_rows].copy_(out, non_blocking=True)
+                    n_rows += out.size(0)
+                    del out
 
         activated_latent_counts, latent_counts = [], []
         for sae in self.sparse_autoencoders:
-            activated = (sae.latent_total_act > 0).sum(dim=-1).tolist()
+            # Latents are post-ReLU, so total activations are never negative
+            activated = t.count_nonzero(sae.latent_total_act, dim=-1).tolist()
             activated_latent_counts.append(activated)
             activated_count = activated if type(activated) == int else max(activated)
             max_latents = max_latents or activated_count
             latent_counts.append(max_idx := min(max_latents, activated_count))
-            sorted_latents = t.sort(sae.latent_total_act, dim=-1, descending=True)
-            idxs_to_keep = sorted_latents.indices[..., :max_idx]
+            idxs_to_keep = t.topk(sae.latent_total_act, max_idx, dim=-1).indices
             sae.prune_latents(idxs_to_keep)
+        if device.type == "cuda":
+            t.cuda.empty_cache()  # Release the memory of the unpruned latents
+
+        print("Done. Autoencoder activated latent counts:", activated_latent_counts)
+        print("Autoencoder latent counts:", latent_counts)
+        if not measure_kl:
+            return
+        assert unpruned_logits is not None and n_rows == unpruned_logits.size(0)
 
-        pruned_logits = []
-        with t.inference_mode():
+        # Equivalent to "batchmean" KL over all flattened tokens, computed per batch
+        kl_sum, n_toks, n_rows = t.tensor(0.0), 0, 0
+        with autocast:
             for batch_idx, batch in (batch_pbar := tqdm(enumerate(dataloader))):
                 batch_pbar_str = f"Testing Pruned Autoencoder: Batch {batch_idx}"
                 batch_pbar.set_description_str(batch_pbar_str)
-                out = self.forward(batch.clean)
-                pruned_logits.append(out)
-                if include_corrupt:
-                    out = self.forward(batch.corrupt)
-                    pruned_logits.append(out)
-
-        flat_pruned_logits = t.flatten(t.stack(pruned_logits), end_dim=-2)
-        flat_unpruned_logits = t.flatten(t.stack(unpruned_logits), end_dim=-2)
-        kl_div = t.nn.functional.kl_div(
-            t.nn.functional.log_softmax(flat_pruned_logits, dim=-1),
-            t.nn.functional.log_softmax(flat_unpruned_logits, dim=-1),
-            reduction="batchmean",
-            log_target=True,
-        )
-
-        print("Done. Autoencoder activated latent counts:", activated_latent_counts)
-        print("Autoencoder latent counts:", latent_counts)
+                inputs = [batch.clean] + ([batch.corrupt] if include_corrupt else [])
+                for toks in inputs:
+                    # Pruning replaced the parameters, so a compiled forward recompiles
+                    out = forward(toks.to(device, non_blocking=True))
+                    batch_rows = slice(n_rows, n_rows + out.size(0))
+                    unpruned_out = unpruned_logits[batch_rows].to(out.device)
+                    kl_sum = kl_sum.to(out.device) + t.nn.functional.kl_div(
+                        t.nn.functional.log_softmax(out.float(), dim=-1),
+                        t.nn.functional.log_softmax(unpruned_out.float(), dim=-1),
+                        reduction="sum",
+                        log_target=True,
+                    )
+                    n_toks += out[..., 0].numel()
+                    n_rows += out.size(0)
+                    del out, unpruned_out
+        kl_div = kl_sum / n_toks
         print("Pruned vs. Unpruned KL Div:", kl_div.item())
 
+    def _compiled_forward(self) -> Callable[..., Any]:
+        return t.compile(self.wrapped_model, mode="reduce-overhead", dynamic=False)
+
     def run_with_cache(self, *args: Any, **kwargs: Any) -> Any:
         return self.wrapped_model.run_with_cache(*args, **kwargs)
 
@@ -116,18 +174,6 @@ class AutoencoderTransformer(t.nn.Module):
     def reset_hooks(self) -> None:
         return self.wrapped_model.reset_hooks()
 
-    @property
-    def cfg(self) -> Any:
-        return self.wrapped_model.cfg
-
-    @property
-    def tokenizer(self) -> Any:
-        return self.wrapped_model.tokenizer
-
-    @property
-    def input_to_embed(self) -> Any:
-        return self.wrapped_model.input_to_embed
-
     @property
     def blocks(self) -> Any:
         return self.wrapped_model.blocks
@@ -186,7 +232,7 @@ def sae_model(
     return AutoencoderTransformer(model, sparse_autoencoders)
 
 
-def factorized_src_nodes(model: AutoencoderTransformer) -> Set[SrcNode]:
+def factorized_src_nodes(model: AutoencoderTransformer) -> List[SrcNode]:
     """Get the source part of each edge in the factorized graph, grouped by layer.
     Graph is factorized following the Mathematical Framework paper."""
     assert model.cfg.use_attn_result  # Get attention head outputs separately
@@ -196,53 +242,59 @@ def factorized_src_nodes(model: AutoencoderTransformer) -> Set[SrcNode]:
         assert model.cfg.use_hook_mlp_in  # Get MLP input BEFORE layernorm
     assert not model.cfg.attn_only
 
-    layers, idxs = count(), count()
-    nodes = set()
-    nodes.add(
+    n_blocks, n_heads = model.cfg.n_layers, model.cfg.n_heads
+    n_latents = [model.blocks[b].hook_mlp_out.n_latents for b in range(n_blocks)]
+    cache_key = (n_blocks, n_heads, tuple(n_latents), model.cfg.parallel_attn_mlp)
+    if cache_key in model._src_nodes_cache:
+        return list(model._src_nodes_cache[cache_key])
+
+    layers_per_block = 1 if model.cfg.parallel_attn_mlp else 2
+    # src_idx of the first node in each block (Resid Start has src_idx 0)
+    block_idxs = list(accumulate([n_heads + n for n in n_latents], initial=1))
+
+    resid_start = SrcNode(
+        name="Resid Start",
+        module_name="blocks.0.hook_resid_pre",
+        layer=0,
+        src_idx=0,
+        weight="embed.W_E",
+    )
+    head_nodes = [
         SrcNode(
-            name="Resid Start",
-            module_name="blocks.0.hook_resid_pre",
-            layer=next(layers),
-            src_idx=next(idxs),
-            weight="embed.W_E",
+            name=f"A{block_idx}.{head_idx}",
+            module_name=f"blocks.{block_idx}.attn.hook_result",
+            layer=1 + block_idx * layers_per_block,
+            src_idx=block_idxs[block_idx] + head_idx,
+            head_dim=2,
+            head_idx=head_idx,
+            weight=f"blocks.{block_idx}.attn.W_O",
+            weight_head_dim=0,
         )
-    )
-
-    for block_idx in range(model.cfg.n_layers):
-        layer = next(layers)
-        for head_idx in range(model.cfg.n_heads):
-            nodes.add(
-                SrcNode(
-                    name=f"A{block_idx}.{head_idx}",
-                    module_name=f"blocks.{block_idx}.attn.hook_result",
-                    layer=layer,
-                    src_idx=next(idxs),
-                    head_dim=2,
-                    head_idx=head_idx,
-                    weight=f"blocks.{block_idx}.attn.W_O",
-                    weight_head_dim=0,
-                )
-            )
-        layer = layer if model.cfg.parallel_attn_mlp else next(layers)
-        for latent_idx in range(model.blocks[block_idx].hook_mlp_out.n_latents):
-            nodes.add(
-                SrcNode(
-                    name=f"MLP {block_idx} Latent {latent_idx}",
-                    module_name=f"blocks.{block_idx}.hook_mlp_out.latent_outs",
-                    layer=layer,
-                    src_idx=next(idxs),
-                    head_dim=2,
-                    head_idx=latent_idx,
-                    weight=f"blocks.{block_idx}.hook_mlp_out.decoder.weight",
-                    weight_head_dim=0,
-                )
-            )
-    return nodes
+        for block_idx, head_idx in product(range(n_blocks), range(n_heads))
+    ]
+    latent_nodes = [
+        SrcNode(
+            name=f"MLP {block_idx} Latent {latent_idx}",
+            module_name=f"blocks.{block_idx}.hook_mlp_out.latent_outs",
+            layer=(block_idx + 1) * layers_per_block,
+            src_idx=block_idxs[block_idx] + n_heads + latent_idx,
+            head_dim=2,
+            head_idx=latent_idx,
+            weight=f"blocks.{block_idx}.hook_mlp_out.decoder.weight",
+            weight_head_dim=0,
+        )
+        for block_idx in range(n_blocks)
+        for latent_idx in range(n_latents[block_idx])
+    ]
+    nodes = [resid_start] + head_nodes + latent_nodes
+    model._src_nodes_cache.clear()  # Free the nodes of the unpruned model
+    model._src_nodes_cache[cache_key] = nodes
+    return list(nodes)
 
 
 def factorized_dest_nodes(
     model: AutoencoderTransformer, separate_qkv: bool
-) -> Set[DestNode]:
+) -> List[DestNode]:
     """Get the destination part of each edge in the factorized graph, grouped by layer.
     Graph is factorized following the Mathematical Framework paper."""
     if separate_qkv:
@@ -251,14 +303,19 @@ def factorized_dest_nodes(
         assert model.cfg.use_attn_in
     if not model.cfg.attn_only:
         assert model.cfg.use_hook_mlp_in  # Get MLP input BEFORE layernorm
+    cfg = model.cfg
+    cache_key = (cfg.n_layers, cfg.n_heads, separate_qkv, cfg.parallel_attn_mlp)
+    if cache_key in model._dest_nodes_cache:
+        return list(model._dest_nodes_cache[cache_key])
+
     layers = count(1)
-    nodes = set()
+    nodes = []
     for block_idx in range(model.cfg.n_layers):
         layer = next(layers)
         for head_idx in range(model.cfg.n_heads):
             if separate_qkv:
                 for letter in ["Q", "K", "V"]:
-                    nodes.add(
+                    nodes.append(
                         DestNode(
                             name=f"A{block_idx}.{head_idx}.{letter}",
                             module_name=f"blocks.{block_idx}.hook_{letter.lower()}_input",
@@ -270,7 +327,7 @@ def factorized_dest_nodes(
                         )
                     )
             else:
-                nodes.add(
+                nodes.append(
                     DestNode(
                         name=f"A{block_idx}.{head_idx}",
                         module_name=f"blocks.{block_idx}.hook_attn_in",
@@ -281,7 +338,7 @@ def factorized_dest_nodes(
                         weight_head_dim=0,
                     )
                 )
-        nodes.add(
+        nodes.append(
             DestNode(
                 name=f"MLP {block_idx}",
                 module_name=f"blocks.{block_idx}.hook_mlp_in",
@@ -289,7 +346,7 @@ def factorized_dest_nodes(
                 weight=f"blocks.{block_idx}.mlp.W_in",
             )
         )
-    nodes.add(
+    nodes.append(
         DestNode(
             name="Resid End",
             module_name=f"blocks.{model.cfg.n_layers - 1}.hook_resid_post",
@@ -297,4 +354,6 @@ def factorized_dest_nodes(
             weight="unembed.W_U",
         )
     )
-    return nodes
+    model._dest_nodes_cache.clear()
+    model._dest_nodes_cache[cache_key] = nodes
+    return list(nodes)
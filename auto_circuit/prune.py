@@ -1,5 +1,5 @@
 from collections import defaultdict
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import torch as t
 
@@ -18,10 +18,11 @@ from auto_circuit.utils.graph_utils import (
 )
 from auto_circuit.utils.misc import module_by_name
 from auto_circuit.utils.patchable_model import PatchableModel
-from auto_circuit.utils.tensor_ops import desc_prune_scores, prune_scores_threshold
+from auto_circuit.utils.tensor_ops import desc_prune_scores
 from auto_circuit.visualize import draw_seq_graph
 
 
+@t.no_grad()
 def run_circuits(
     model: PatchableModel,
     dataloader: PromptDataLoader,
@@ -33,6 +34,8 @@ def run_circuits(
     render_graph: bool = False,
     render_score_threshold: bool = False,
     render_file_path: Optional[str] = None,
+    compile_model: bool = False,
+    out_device: Optional[t.device] = None,
 ) -> CircuitOutputs:
     """Run the model, pruning edges based on the given `prune_scores`. Runs the model
     over the given `dataloader` for each `test_edge_count`.
@@ -48,6 +51,12 @@ def run_circuits(
         render_graph: Whether to render the graph using `draw_seq_graph`.
         render_score_threshold: Edge score threshold, if `render_graph` is `True`.
         render_file_path: Path to save the rendered graph, if `render_graph` is `True`.
+        compile_model: Whether to run the model forward passes through
+            `torch.compile`. Only worthwhile for large datasets, because the model may
+            be recompiled when the patch masks change.
+        out_device: The device on which to store the outputs. If `None`, the outputs
+            are kept on the device of the model. Pass `t.device("cpu")` to avoid running
+            out of GPU memory with large datasets or many `test_edge_counts`.
 
     Returns:
         A dictionary mapping from the number of pruned edges to a
@@ -56,50 +65,92 @@ def run_circuits(
             tensors.
     """
     circ_outs: CircuitOutputs = defaultdict(dict)
+    # One output buffer per edge count, indexed by batch (batches are equal size)
+    out_buffers: Dict[int, t.Tensor] = {}
     desc_ps: t.Tensor = desc_prune_scores(prune_scores)
 
+    # The masks don't depend on the batch, so look up the modules and thresholds once
+    dest_scores: List[Tuple[PatchWrapper, t.Tensor]] = []
+    for mod_name, patch_mask in prune_scores.items():
+        dest = module_by_name(model, mod_name)
+        assert isinstance(dest, PatchWrapper)
+        assert dest.is_dest and dest.patch_mask is not None
+        dest_scores.append((dest, patch_mask.abs()))
+    # Same as prune_scores_threshold, for all the edge counts in one indexing op
+    inf = desc_ps.new_full((1,), float("inf"))  # No edges are above the 0th threshold
+    count_idxs = t.tensor(test_edge_counts, dtype=t.long, device=desc_ps.device)
+    thresholds = t.cat([inf, desc_ps])[count_idxs]
+    # When prune_scores are tied we can't prune exactly edge_count edges. Both patch
+    # types patch the edges with scores above the threshold (in or out of the circuit).
+    n_below = t.searchsorted(desc_ps.flip(0), thresholds, side="left")
+    patch_edge_counts: List[int] = (desc_ps.numel() - n_below).tolist()
+
     patch_src_outs: Optional[t.Tensor] = None
     if ablation_type.mean_over_dataset:
         patch_src_outs = src_ablations(model, dataloader, ablation_type)
+    zero_input_shape: Optional[t.Size] = None
+    curr_src_outs: Optional[t.Tensor] = None
+    forward, out_slice = model, model.out_slice
+    if compile_model:  # Hooks mutate module state, so allow graph breaks
+        forward = t.compile(model, fullgraph=False, dynamic=False)
 
     for batch_idx, batch in enumerate(batch_pbar := tqdm(dataloader)):
         batch_pbar.set_description_str(f"Pruning Batch {batch_idx}", refresh=True)
         if (patch_type == PatchType.TREE_PATCH and not reverse_clean_corrupt) or (
             patch_type == PatchType.EDGE_PATCH and reverse_clean_corrupt
         ):
-            batch_input = batch.clean
-            if not ablation_type.mean_over_dataset:
-                patch_src_outs = src_ablations(model, batch.corrupt, ablation_type)
+            batch_input, patch_input = batch.clean, batch.corrupt
         elif (patch_type == PatchType.EDGE_PATCH and not reverse_clean_corrupt) or (
             patch_type == PatchType.TREE_PATCH and reverse_clean_corrupt
         ):
-            batch_input = batch.corrupt
-            if not ablation_type.mean_over_dataset:
-                patch_src_outs = src_ablations(model, batch.clean, ablation_type)
+            batch_input, patch_input = batch.corrupt, batch.clean
         else:
             raise NotImplementedError
 
+        if ablation_type == AblationType.ZERO:
+            # Zero ablations only depend on the input shape, so reuse them if possible
+            if zero_input_shape != patch_input.shape:
+                patch_src_outs = src_ablations(model, patch_input, ablation_type)
+                zero_input_shape = patch_input.shape
+        elif not ablation_type.mean_over_dataset:
+            patch_src_outs = None  # Free the last batch's ablations before the next
+            patch_src_outs = src_ablations(model, patch_input, ablation_type)
+
         assert patch_src_outs is not None
-        with patch_mode(model, patch_src_outs):
-            for edge_count in (edge_pbar := tqdm(test_edge_counts)):
+        # Reuse the buffer for the current src outputs instead of reallocating it
+        if curr_src_outs is None or curr_src_outs.shape != patch_src_outs.shape:
+            curr_src_outs = t.zeros_like(patch_src_outs)
+        else:
+            curr_src_outs.zero_()
+        with patch_mode(model, patch_src_outs, curr_src_outs=curr_src_outs):
+            for edge_count, threshold, patch_edge_count in zip(
+                edge_pbar := tqdm(test_edge_counts), thresholds, patch_edge_counts
+            ):
                 edge_pbar.set_description_str(f"Running Circuit: {edge_count} Edges")
-                threshold = prune_scores_threshold(desc_ps, edge_count)
-                # When prune_scores are tied we can't prune exactly edge_count edges
-                patch_edge_count = 0
-                for mod_name, patch_mask in prune_scores.items():
-                    dest = module_by_name(model, mod_name)
-                    assert isinstance(dest, PatchWrapper)
-                    assert dest.is_dest and dest.patch_mask is not None
+                for dest, abs_scores in dest_scores:
                     if patch_type == PatchType.EDGE_PATCH:
-                        dest.patch_mask.data = (patch_mask.abs() >= threshold).float()
-                        patch_edge_count += dest.patch_mask.int().sum().item()
+                        dest.patch_mask.data = (abs_scores >= threshold).float()
                     else:
                         assert patch_type == PatchType.TREE_PATCH
-                        dest.patch_mask.data = (patch_mask.abs() < threshold).float()
-                        patch_edge_count += (1 - dest.patch_mask.int()).sum().item()
-                with t.inference_mode():
-                    model_output = model(batch_input)[model.out_slice]
-                circ_outs[patch_edge_count][batch.key] = model_output.detach().clone()
+                        dest.patch_mask.data = (abs_scores < threshold).float()
+                model_output = forward(batch_input)[out_slice]
+                if (out_buf := out_buffers.get(patch_edge_count)) is None:
+                    device = out_device or model_output.device
+                    out_buf = t.empty(
+                        (len(dataloader),) + model_output.shape,
+                        dtype=model_output.dtype,
+                        device=device,
+                        pin_memory=device.type == "cpu" and model_output.is_cuda,
+                    )
+                    out_buffers[patch_edge_count] = out_buf
+                if out_buf.shape[1:] == model_output.shape:
+                    out_buf[batch_idx].copy_(model_output, non_blocking=True)
+                    circ_out = out_buf[batch_idx]
+                else:  # Batches with different sequence lengths can't share the buffer
+                    device = out_device or model_output.device
+                    circ_out = model_output.to(device, copy=True)
+                del model_output
+                circ_outs[patch_edge_count][batch.key] = circ_out
             if render_graph:
                 draw_seq_graph(
                     model=model,
@@ -108,5 +159,7 @@ def run_circuits(
                     seq_labels=dataloader.seq_labels,
                     file_path=render_file_path,
                 )
-    del patch_src_outs
+    del patch_src_outs, curr_src_outs
+    if any([out_buf.is_pinned() for out_buf in out_buffers.values()]):
+        t.cuda.synchronize()  # Wait for the non_blocking copies to the host to finish
     return circ_outs
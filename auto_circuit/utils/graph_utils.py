@@ -165,8 +165,9 @@ def graph_edges(
             dests: Set[DestNode] = tl_utils.factorized_dest_nodes(model, separate_qkv)
         elif isinstance(model, AutoencoderTransformer):
             assert separate_qkv is not None, "separate_qkv must be specified for LLM"
-            srcs: Set[SrcNode] = sae_utils.factorized_src_nodes(model)
-            dests: Set[DestNode] = sae_utils.factorized_dest_nodes(model, separate_qkv)
+            # PatchableModel stores nodes as sets, so convert the lists once here
+            srcs = set(sae_utils.factorized_src_nodes(model))
+            dests = set(sae_utils.factorized_dest_nodes(model, separate_qkv))
         else:
             raise NotImplementedError(model)
         for i in [None] if seq_len is None else range(seq_len):
@@ -298,9 +299,15 @@ def patch_mode(
     # TODO: Raise an error if one of the edge names doesn't exist.
     if edges is not None:
         set_all_masks(model, val=0.0)
+        # Group the edges by patch mask so that each mask is written in a single op
+        mask_idxs: Dict[str, List[Tuple[int, ...]]] = defaultdict(list)
         for edge in model.edges:
             if edge in edges or edge.name in edges:
-                edge.patch_mask(model).data[edge.patch_idx] = 1.0
+                mask_idxs[edge.dest.module_name].append(edge.patch_idx)
+        for mod_name, idxs in mask_idxs.items():
+            patch_mask = model.patch_masks[mod_name]
+            idx_tensor = t.tensor(idxs, dtype=t.long, device=patch_mask.device)
+            patch_mask.data[idx_tensor.unbind(dim=-1)] = 1.0
 
     for wrapper in model.wrappers:
         wrapper.patch_mode = True
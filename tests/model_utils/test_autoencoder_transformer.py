@@ -1,5 +1,6 @@
 #%%
-from typing import Optional
+from itertools import count
+from typing import Dict, Optional, Tuple
 
 import pytest
 import torch as t
@@ -9,6 +10,7 @@ from transformer_lens.hook_points import HookPoint
 from auto_circuit.data import load_datasets_from_json
 from auto_circuit.model_utils.sparse_autoencoders.autoencoder_transformer import (
     AutoencoderTransformer,
+    factorized_src_nodes,
     sae_model,
 )
 from auto_circuit.model_utils.sparse_autoencoders.sparse_autoencoder import (
@@ -108,8 +110,10 @@ def test_autoencoder_transformer_output_similarity(
 
 
 @pytest.mark.parametrize("hooked_transformer", MODEL_NAMES, indirect=True)
+@pytest.mark.parametrize("measure_kl", [True, False])
 def test_prune_latents_with_dataset(
     hooked_transformer: HookedTransformer,
+    measure_kl: bool,
     autoencoder_input: AutoencoderInput = "resid_delta_mlp",
     pythia_size: Optional[str] = "0_8192",
     print_top_k: Optional[int] = None,
@@ -133,8 +137,24 @@ def test_prune_latents_with_dataset(
         return_seq_length=True,
     )
     encoder_model._prune_latents_with_dataset(
-        train_loader, 100, seq_len=train_loader.seq_len
+        train_loader, 100, seq_len=train_loader.seq_len, measure_kl=measure_kl
     )
+    if not measure_kl:
+        # Skipping the KL pass shouldn't change which latents are kept
+        reference_model = sae_model(
+            hooked_transformer,
+            autoencoder_input,
+            load_pretrained=True,
+            pythia_size=pythia_size,
+            new_instance=True,
+        )
+        reference_model._prune_latents_with_dataset(
+            train_loader, 100, seq_len=train_loader.seq_len, measure_kl=True
+        )
+        saes = encoder_model.sparse_autoencoders
+        ref_saes = reference_model.sparse_autoencoders
+        assert [sae.n_latents for sae in saes] == [sae.n_latents for sae in ref_saes]
+        del reference_model
 
     toks: t.Tensor = test_loader.dataset[0].clean
     prompts = default_model.tokenizer.decode(toks, True)  # type: ignore
@@ -150,6 +170,68 @@ def test_prune_latents_with_dataset(
     del encoder_model
 
 
+def counter_src_node_idxs(model: AutoencoderTransformer) -> Dict[str, Tuple[int, int]]:
+    """The `(layer, src_idx)` of each source node, counted node by node."""
+    layers, idxs = count(), count()
+    node_idxs = {"Resid Start": (next(layers), next(idxs))}
+    for block_idx in range(model.cfg.n_layers):
+        layer = next(layers)
+        for head_idx in range(model.cfg.n_heads):
+            node_idxs[f"A{block_idx}.{head_idx}"] = (layer, next(idxs))
+        layer = layer if model.cfg.parallel_attn_mlp else next(layers)
+        for latent_idx in range(model.blocks[block_idx].hook_mlp_out.n_latents):
+            node_idxs[f"MLP {block_idx} Latent {latent_idx}"] = (layer, next(idxs))
+    return node_idxs
+
+
+@pytest.mark.parametrize("hooked_transformer", MODEL_NAMES, indirect=True)
+@pytest.mark.parametrize("parallel_attn_mlp", [True, False])
+def test_factorized_src_nodes_after_pruning(
+    hooked_transformer: HookedTransformer,
+    parallel_attn_mlp: bool,
+    autoencoder_input: AutoencoderInput = "resid_delta_mlp",
+    pythia_size: Optional[str] = "0_8192",
+):
+    """Check the source nodes are numbered correctly when the autoencoders in each
+    layer have different numbers of latents."""
+    encoder_model = sae_model(
+        hooked_transformer,
+        autoencoder_input,
+        load_pretrained=True,
+        pythia_size=pythia_size,
+        new_instance=True,
+    )
+    encoder_model.cfg.parallel_attn_mlp = parallel_attn_mlp  # Only changes the layers
+    n_heads, n_layers = encoder_model.cfg.n_heads, encoder_model.cfg.n_layers
+    unpruned_latents = [sae.n_latents for sae in encoder_model.sparse_autoencoders]
+    unpruned_nodes = factorized_src_nodes(encoder_model)
+    assert len(unpruned_nodes) == 1 + n_heads * n_layers + sum(unpruned_latents)
+
+    train_loader, _ = load_datasets_from_json(
+        model=hooked_transformer,
+        path=repo_path_to_abs_path("datasets/mini_prompts.json"),
+        device=t.device("cpu"),
+        prepend_bos=True,
+        batch_size=1,
+        train_test_size=(1, 1),
+    )
+    encoder_model._prune_latents_with_dataset(train_loader, 100, measure_kl=False)
+    # Make sure that every layer has a different number of latents
+    for layer_idx, sae in enumerate(encoder_model.sparse_autoencoders):
+        assert sae.n_latents >= 10 + layer_idx
+        sae.prune_latents(t.arange(10 + layer_idx, device=sae.encode_weight.device))
+
+    nodes = factorized_src_nodes(encoder_model)
+    # The cached nodes from before pruning must not be returned
+    n_latents = [sae.n_latents for sae in encoder_model.sparse_autoencoders]
+    assert len(nodes) == 1 + n_heads * n_layers + sum(n_latents)
+    assert len(encoder_model._src_nodes_cache) == 1
+    assert sorted([node.src_idx for node in nodes]) == list(range(len(nodes)))
+    node_idxs = {node.name: (node.layer, node.src_idx) for node in nodes}
+    assert node_idxs == counter_src_node_idxs(encoder_model)
+    del encoder_model
+
+
 @pytest.mark.parametrize("model_name", MODEL_NAMES)
 def test_task_autoencoder_transformer_edges(model_name: str):
     """Load an autoencoder model, make it a PatchableModel.
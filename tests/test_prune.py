@@ -1,16 +1,17 @@
 #%%
 import os
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 import pytest
 import torch as t
 
 from auto_circuit.data import (
     PromptDataLoader,
+    PromptDataset,
 )
 from auto_circuit.model_utils.micro_model_utils import MicroModel
 from auto_circuit.prune import run_circuits
-from auto_circuit.types import Edge, PatchType, PruneScores
+from auto_circuit.types import AblationType, Edge, PatchType, PruneScores
 from auto_circuit.utils.graph_utils import patchable_model
 from auto_circuit.utils.patchable_model import PatchableModel
 from tests.conftest import DEVICE
@@ -19,10 +20,12 @@ os.environ["TOKENIZERS_PARALLELISM"] = "False"
 
 
 @pytest.mark.parametrize("seq_len", [None, 3])
+@pytest.mark.parametrize("out_device", [None, t.device("cpu")])
 def test_pruning(
     micro_model: MicroModel,
     micro_dataloader: PromptDataLoader,
     seq_len: Optional[int],
+    out_device: Optional[t.device],
     show_graphs: bool = False,
 ):
     """Check that pruning works by pruning a "MicroModel" where the correct output can
@@ -67,9 +70,12 @@ def test_pruning(
         prune_scores=prune_scores,
         patch_type=PatchType.EDGE_PATCH,
         render_graph=show_graphs,
+        out_device=out_device,
     )
     key = test_batch.key
-    assert t.allclose(circ_outs[0][key], corrupt_out[:, -1], atol=1e-3)
+    for edge_count in [0, 1, 2, 3]:
+        assert circ_outs[edge_count][key].device.type == (out_device or DEVICE).type
+    assert t.allclose(circ_outs[0][key].cpu(), corrupt_out[:, -1].cpu(), atol=1e-3)
     assert t.allclose(circ_outs[1][key].cpu(), t.tensor([[-19.0, -41.0]]), atol=1e-3)
     assert t.allclose(circ_outs[2][key].cpu(), t.tensor([[-13.0, -25.0]]), atol=1e-3)
     assert t.allclose(circ_outs[3][key].cpu(), t.tensor([[-9.0, -13.0]]), atol=1e-3)
@@ -80,6 +86,76 @@ def test_pruning(
 # test_pruning(model, dataloader, seq_len=None, show_graphs=True)
 
 
+@pytest.mark.parametrize(
+    "ablation_type, expected_outs",
+    [
+        (
+            AblationType.RESAMPLE,
+            {0: [-25.0, -49.0], 1: [-19.0, -41.0], 3: [-9.0, -13.0]},
+        ),
+        (AblationType.ZERO, {0: [-25.0, -49.0], 1: [-22.0, -45.0], 3: [-17.0, -31.0]}),
+    ],
+)
+def test_pruning_multiple_batches(
+    micro_model: MicroModel,
+    micro_dataloader: PromptDataLoader,
+    ablation_type: AblationType,
+    expected_outs: Dict[int, List[float]],
+):
+    """Check that each batch gets its own outputs when pruning over several batches,
+    including when tied scores give several `test_edge_counts` the same outputs. With
+    `AblationType.ZERO` the ablations of the first batch are reused by the others.
+
+    The MicroModel is linear, so scaling the prompts scales all of the outputs.
+    """
+    model: PatchableModel = patchable_model(
+        model=micro_model,
+        factorized=True,
+        slice_output="last_seq",
+        separate_qkv=True,
+        device=DEVICE,
+    )
+    prompt = next(iter(micro_dataloader))
+    # Scale each batch differently so the batches have different keys and outputs
+    scales = [1.0, 2.0, 3.0]
+    dataset = PromptDataset(
+        [prompt.clean[0] * scale for scale in scales],
+        [prompt.corrupt[0] * scale for scale in scales],
+        [prompt.answers[0] for _ in scales],
+        [prompt.wrong_answers[0] for _ in scales],
+    )
+    test_loader = PromptDataLoader(dataset, seq_len=None, diverge_idx=0, batch_size=1)
+
+    edge_dict = dict([(edge.name, edge) for edge in model.edges])
+    prune_scores: PruneScores = model.new_prune_scores()
+    prune_edges: Dict[str, float] = {
+        "B0.1->Resid End": 3.0,
+        "B0.0->B1.1": 2.0,
+        "Resid Start->B0.0": 2.0,
+    }
+    for edge_name, score in prune_edges.items():
+        edge = edge_dict[edge_name]
+        prune_scores[edge.dest.module_name][edge.patch_idx] = score
+
+    circ_outs = run_circuits(
+        model=model,
+        dataloader=test_loader,
+        test_edge_counts=[0, 1, 2, 3],
+        prune_scores=prune_scores,
+        patch_type=PatchType.EDGE_PATCH,
+        ablation_type=ablation_type,
+    )
+    # The last two edges are tied, so 2 and 3 edges both patch 3 edges
+    assert set(circ_outs.keys()) == set(expected_outs.keys())
+    batches = list(test_loader)
+    assert len(set([batch.key for batch in batches])) == len(scales)
+    for edge_count, expected_out in expected_outs.items():
+        assert set(circ_outs[edge_count].keys()) == set([b.key for b in batches])
+        for scale, batch in zip(scales, batches):
+            circ_out = circ_outs[edge_count][batch.key].cpu()
+            assert t.allclose(circ_out, t.tensor([expected_out]) * scale, atol=1e-3)
+
+
 def test_prune_sequence(
     micro_model: MicroModel,
     micro_dataloader: PromptDataLoader,
@@ -123,3 +199,82 @@ def test_prune_sequence(
 
 
 # test_prune_sequence(model, dataloader, show_graphs=True)
+
+
+def test_pruning_different_seq_lens(
+    micro_model: MicroModel,
+    micro_dataloader: PromptDataLoader,
+):
+    """Check that pruning works when the batches have different sequence lengths, so
+    the outputs of each batch have different shapes."""
+    model: PatchableModel = patchable_model(
+        model=micro_model, factorized=True, slice_output=None, device=DEVICE
+    )
+    prompt = next(iter(micro_dataloader))
+    # Scale each batch differently so the batches have different keys
+    seq_lens, scales = [3, 2, 3], [1.0, 2.0, 3.0]
+    dataset = PromptDataset(
+        [prompt.clean[0, -n:] * s for n, s in zip(seq_lens, scales)],
+        [prompt.corrupt[0, -n:] * s for n, s in zip(seq_lens, scales)],
+        [prompt.answers[0] for _ in scales],
+        [prompt.wrong_answers[0] for _ in scales],
+    )
+    test_loader = PromptDataLoader(dataset, seq_len=None, diverge_idx=0, batch_size=1)
+
+    prune_scores = model.new_prune_scores()
+    for mod_name, scores in prune_scores.items():
+        prune_scores[mod_name] = t.ones_like(scores)
+    circ_outs = run_circuits(
+        model=model,
+        dataloader=test_loader,
+        test_edge_counts=[0, model.n_edges],
+        prune_scores=prune_scores,
+        patch_type=PatchType.EDGE_PATCH,
+    )
+    for seq_len, batch in zip(seq_lens, test_loader):
+        with t.inference_mode():
+            clean_out = model(batch.clean)[model.out_slice]
+            corrupt_out = model(batch.corrupt)[model.out_slice]
+        assert circ_outs[0][batch.key].shape == (1, seq_len, 2)
+        assert t.allclose(circ_outs[0][batch.key], corrupt_out, atol=1e-3)
+        assert t.allclose(circ_outs[model.n_edges][batch.key], clean_out, atol=1e-3)
+
+
+@pytest.mark.skipif(not hasattr(t, "compile"), reason="torch.compile not available")
+def test_pruning_compiled(micro_model: MicroModel, micro_dataloader: PromptDataLoader):
+    """Check that running the circuits through `torch.compile` doesn't change the
+    outputs."""
+    model: PatchableModel = patchable_model(
+        model=micro_model,
+        factorized=True,
+        slice_output="last_seq",
+        separate_qkv=True,
+        device=DEVICE,
+    )
+    edge_dict = dict([(edge.name, edge) for edge in model.edges])
+    prune_scores: PruneScores = model.new_prune_scores()
+    prune_edges: Dict[str, float] = {
+        "B0.1->Resid End": 3.0,
+        "B0.0->B1.1": 2.0,
+        "Resid Start->B0.0": 1.0,
+    }
+    for edge_name, score in prune_edges.items():
+        edge = edge_dict[edge_name]
+        prune_scores[edge.dest.module_name][edge.patch_idx] = score
+
+    test_edge_counts = [0, 1, 2, 3]
+    eager_outs, compiled_outs = [
+        run_circuits(
+            model=model,
+            dataloader=micro_dataloader,
+            test_edge_counts=test_edge_counts,
+            prune_scores=prune_scores,
+            patch_type=PatchType.EDGE_PATCH,
+            compile_model=compile_model,
+        )
+        for compile_model in [False, True]
+    ]
+    key = next(iter(micro_dataloader)).key
+    for edge_count in test_edge_counts:
+        eager_out, compiled_out = eager_outs[edge_count], compiled_outs[edge_count]
+        assert t.allclose(compiled_out[key], eager_out[key], atol=1e-3)
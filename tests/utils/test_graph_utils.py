@@ -1,12 +1,22 @@
 #%%
 import os
-from typing import List, Set
+from typing import List, Optional, Set
 
+import pytest
+import torch as t
 import transformer_lens as tl
 
+from auto_circuit.data import PromptDataLoader
 from auto_circuit.model_utils.micro_model_utils import MicroModel
 from auto_circuit.types import Edge, EdgeCounts
-from auto_circuit.utils.graph_utils import edge_counts_util, patchable_model
+from auto_circuit.utils.ablation_activations import src_ablations
+from auto_circuit.utils.graph_utils import (
+    edge_counts_util,
+    patch_mode,
+    patchable_model,
+    set_all_masks,
+)
+from tests.conftest import DEVICE
 
 os.environ["TOKENIZERS_PARALLELISM"] = "False"
 
@@ -81,3 +91,30 @@ def test_groups_edge_counts(micro_model: MicroModel):
 # test_groups_edge_counts(model)
 
 # %%
+
+
+@pytest.mark.parametrize("seq_len", [None, 3])
+def test_patch_mode_edges(
+    micro_model: MicroModel,
+    micro_dataloader: PromptDataLoader,
+    seq_len: Optional[int],
+):
+    """Check that `patch_mode` sets the same masks as setting each edge separately."""
+    model = patchable_model(
+        micro_model, factorized=True, seq_len=seq_len, device=DEVICE
+    )
+    edge_list = sorted(model.edges, key=lambda e: (e.seq_idx or 0, e.name))
+    edges = edge_list[::2]
+
+    set_all_masks(model, val=0.0)
+    for edge in edges:
+        edge.patch_mask(model).data[edge.patch_idx] = 1.0
+    expected_masks = {n: mask.detach().clone() for n, mask in model.patch_masks.items()}
+
+    set_all_masks(model, val=0.5)  # patch_mode should reset the other masks
+    batch = next(iter(micro_dataloader))
+    ablations = src_ablations(model, batch.corrupt)
+    with patch_mode(model, ablations, edges):
+        for mod_name, patch_mask in model.patch_masks.items():
+            assert t.equal(patch_mask.data, expected_masks[mod_name])
+    set_all_masks(model, val=0.0)